@@ -1,11 +1,24 @@
 import os
+import asyncio
 import time
+import random
+import queue
+import itertools
+import threading
+import re
 import subprocess
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import json
 import srt
 from datetime import datetime
-from google.api_core.exceptions import ResourceExhausted
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServerError
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import DirCreatedEvent, FileClosedEvent, FileCreatedEvent, FileDeletedEvent, FileMovedEvent
+except ImportError:  # Fall back to polling the watch directory
+    Observer = None
 
 def log(message):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -15,152 +28,648 @@ def log(message):
 WATCH_DIRECTORY = os.getenv("WATCH_DIRECTORY", "/videos")
 TARGET_LANGUAGE = os.getenv("TARGET_LANGUAGE", "en")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", "60")) # In seconds
+SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", "60")) # In seconds, only used when watchdog is unavailable
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4")) # Videos translated at the same time
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "2")) # Gemini requests in flight across all videos
+STATE_FILE = os.path.expanduser(os.getenv("STATE_FILE", "~/.subtrans/state.json")) # Remembers translated videos across restarts
 # ------------------------
 
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not set.")
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Ping the server every 30 seconds while a request is in flight so long translation runs keep
+# reusing the same connection instead of having it dropped and paying a new TCP/TLS handshake
+GRPC_KEEPALIVE_OPTIONS = [("grpc.keepalive_time_ms", 30000)]
+
+GenerativeServiceGrpcTransport = glm.GenerativeServiceClient.get_transport_class("grpc")
+
+class KeepaliveGrpcTransport(GenerativeServiceGrpcTransport):
+    """gRPC transport for the generative service whose channel uses GRPC_KEEPALIVE_OPTIONS."""
+
+    @classmethod
+    def create_channel(cls, *args, options=(), **kwargs):
+        return super().create_channel(*args, options=[*options, *GRPC_KEEPALIVE_OPTIONS], **kwargs)
+
+# genai.configure() only accepts a transport name, so the generative client's "grpc" entry is swapped out
+type(glm.GenerativeServiceClient)._transport_registry["grpc"] = KeepaliveGrpcTransport
+
+genai.configure(api_key=GEMINI_API_KEY, transport="grpc")
+
+# Shared by every translation thread so the client and its connection are created only once
+MODEL = genai.GenerativeModel('gemini-2.5-flash')
+
+# Subtitles are translated CHUNKS_PER_REQUEST chunks of CHUNK_SIZE subtitles per Gemini request.
+# An SRT block is roughly 40-50 output tokens (the timestamp line alone is about 25), so 100 subtitles
+# come to about 5k tokens and leave headroom in an 8k-token output window. A reply that is still
+# cut off at the token limit is retried like any other invalid translation.
+CHUNK_SIZE = 50
+CHUNKS_PER_REQUEST = 2
+CHUNK_MARKER_RE = re.compile(r"^### CHUNK (\d+) ###[ \t]*$", re.MULTILINE)
+# A markdown code fence around the response; the closing fence is optional in case the output was cut off
+MARKDOWN_FENCE_RE = re.compile(r"^\s*```(?:srt)?[ \t]*\n?(.*?)\s*(?:```\s*)?$", re.DOTALL)
+
+# Instructions sent ahead of every chunk; built once since TARGET_LANGUAGE never changes
+PROMPT_PREFIX = (
+    f"You are an expert translator specializing in subtitles for movies, TV, and animation. "
+    f"""Your task is to translate the provided SRT subtitle content into {TARGET_LANGUAGE}, making it sound as natural as possible, as if it were originally written in Korean.
+
+"""
+    """Follow these instructions carefully:
+"""
+    """1. **Natural Translation:** The translation must be fluent and natural. Avoid stiff, literal translations.
+2. **Completeness:** It is absolutely critical that you translate the entire content from beginning to end. Do not omit any lines.
+3. **Strict SRT Format Preservation:** You MUST strictly preserve the original SRT format. This includes:
+   - Exact sequential numbering (e.g., 1, 2, 3...)
+   - Exact timestamps (e.g., 00:00:01,000 --> 00:00:03,500)
+   - All original formatting tags (e.g., <i>, <b>, <font color=\"#RRGGBB\">)
+   - Correct line breaks between subtitle text and the next number/timestamp block.
+   - Do NOT add any extra blank lines unless they are present in the original SRT.
+4. **Keep Chunk Markers:** The content is split into chunks, each starting with a line like `### CHUNK 1 ###`. Copy every marker line unchanged on its own line before the translation of that chunk.
+5. **Output ONLY SRT:** Your final output MUST be ONLY the complete, translated SRT file content with its chunk markers. Do NOT include any conversational text, explanations, markdown code blocks (like ```srt or ```), or any other extraneous characters before or after the SRT content. Just the raw SRT text.
 
-last_scanned_files = set()
+"""
+)
+
+# Retry policies for a Gemini request, by kind of failure
+QUOTA_RETRIES = 10 # Rate limited: wait for Retry-After, else back off exponentially up to QUOTA_RETRY_MAX_WAIT seconds
+QUOTA_RETRY_BASE_WAIT = 5
+QUOTA_RETRY_MAX_WAIT = 60
+VALIDATION_RETRY_TEMPERATURES = (0.6, 0.3, 0.0) # Unusable output: retry at once, each time less creative
+NETWORK_RETRY_WAITS = (1, 2, 4) # Transient server/network errors: retry quickly
+NETWORK_ERRORS = (ServerError, DeadlineExceeded, ConnectionError, TimeoutError)
+
+VIDEO_EXTENSIONS = frozenset({'mp4', 'mkv', 'avi', 'mov'})
+# Bitmap subtitle codecs (ffprobe codec_name) that ffmpeg cannot convert to SRT
+IMAGE_SUBTITLE_CODECS = frozenset({'hdmv_pgs_subtitle', 'dvd_subtitle', 'dvb_subtitle', 'xsub'})
+
+# A file whose size or mtime still changes over WRITE_SETTLE_SECONDS is still being written, and the
+# same unchanged file reported again within DEBOUNCE_SECONDS (e.g. several close events) is queued once
+WRITE_SETTLE_SECONDS = 2
+DEBOUNCE_SECONDS = 5
+
+# Only the events that mean "a file is ready" (plus deletions for logging) are
+# requested, so the kernel doesn't report every read/modify inside the library.
+# A file moved in from outside the watched tree is reported as created, not moved.
+WATCH_EVENTS = [FileClosedEvent, FileCreatedEvent, FileMovedEvent, FileDeletedEvent, DirCreatedEvent] if Observer else []
+
+# Processing pipeline: new video files (fed by the watcher or the polling fallback) are
+# probed, then extracted, then translated, each stage running in its own thread(s).
+# Every item is a tuple starting with the video path, followed by the previous stage's output.
+video_queue = queue.Queue()
+extract_queue = queue.Queue()
+translate_queue = queue.Queue()
+
+# Shared by every worker so concurrent videos stay within the Gemini rate limit
+gemini_semaphore = threading.Semaphore(GEMINI_CONCURRENCY)
+
+# Recently queued videos, keyed by path: ((size, mtime), time queued)
+recently_queued = {}
+recently_queued_lock = threading.Lock()
+
+# Videos already translated, keyed by path: {"mtime": ..., "size": ..., "status": "done" or "partial"}
+processed_state = {}
+state_lock = threading.Lock()
+
+def is_video_file(path):
+    _, dot, extension = path.rpartition('.')
+    return bool(dot) and extension.lower() in VIDEO_EXTENSIONS
 
 def get_video_files(directory):
-    video_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(('.mp4', '.mkv', '.avi', '.mov')):
-                video_files.append(os.path.join(root, file))
-    return video_files
+    # os.scandir reports file types from the directory listing itself, so no file is stat'ed
+    pending_directories = [directory]
+    while pending_directories:
+        try:
+            with os.scandir(pending_directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and is_video_file(entry.name):
+                        yield entry.path
+        except OSError:
+            continue # Unreadable directory, skipped like os.walk does
+
+def get_file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None # Removed or renamed in the meantime
+    return (stat.st_size, stat.st_mtime)
+
+def queue_video(path, signature):
+    now = time.monotonic()
+    with recently_queued_lock:
+        previous = recently_queued.get(path)
+        if previous and previous[0] == signature and now - previous[1] < DEBOUNCE_SECONDS:
+            return
+        for queued_path, (_, queued_at) in list(recently_queued.items()):
+            if now - queued_at >= DEBOUNCE_SECONDS:
+                del recently_queued[queued_path]
+        recently_queued[path] = (signature, now)
+
+    log(f"\nDetected new video file: {os.path.basename(path)}")
+    video_queue.put((path,))
+
+def queue_video_if_settled(path, signature):
+    settled_signature = get_file_signature(path)
+    if settled_signature is None:
+        return
+    if settled_signature != signature:
+        # Still being written; the watcher reports the file again when the writer closes it
+        return
+    queue_video(path, signature)
+
+class VideoEventHandler:
+    """Receives watchdog events and queues video files once they are fully written."""
+
+    def dispatch(self, event):
+        if event.event_type == "created" and event.is_directory:
+            # A directory moved or copied in may already contain videos
+            for video_file in get_video_files(event.src_path):
+                self.enqueue(video_file)
+        elif event.is_directory:
+            return
+        elif event.event_type in ("created", "closed"):
+            # A file still being written when it's created fails the settle check and is queued once closed
+            self.enqueue(event.src_path)
+        elif event.event_type == "moved":
+            self.enqueue(event.dest_path)
+        elif event.event_type == "deleted" and is_video_file(event.src_path):
+            log(f"Detected removed video file: {os.path.basename(event.src_path)}")
+
+    def enqueue(self, path):
+        if not is_video_file(path):
+            return
+        signature = get_file_signature(path)
+        if signature is not None:
+            # Check again after a moment instead of blocking the watchdog thread
+            threading.Timer(WRITE_SETTLE_SECONDS, queue_video_if_settled, args=(path, signature)).start()
+
+def poll_for_new_files(last_scanned_files):
+    while True:
+        # No log statement here for quiet running, it will only log when new files are detected.
+        time.sleep(SCAN_INTERVAL)
+
+        current_files = set(get_video_files(WATCH_DIRECTORY))
+        new_files = current_files - last_scanned_files
+        removed_files = last_scanned_files - current_files
+
+        if new_files:
+            signatures = {video_file: get_file_signature(video_file) for video_file in new_files}
+            time.sleep(WRITE_SETTLE_SECONDS)
+            for video_file, signature in signatures.items():
+                if signature is None or get_file_signature(video_file) != signature:
+                    # Still being written; forget it so the next scan picks it up again
+                    current_files.discard(video_file)
+                else:
+                    queue_video(video_file, signature)
+
+        if removed_files:
+            log(f"\nDetected {len(removed_files)} removed video file(s).")
+            for video_file in removed_files:
+                log(f"  - Removed: {os.path.basename(video_file)}")
+
+        last_scanned_files = current_files
+
+def start_watcher(last_scanned_files):
+    if Observer is None:
+        log(f"\nwatchdog is not installed. Starting to watch for new files. Scanning every {SCAN_INTERVAL} seconds...")
+        threading.Thread(target=poll_for_new_files, args=(last_scanned_files,), daemon=True).start()
+        return
+
+    observer = Observer()
+    observer.schedule(VideoEventHandler(), WATCH_DIRECTORY, recursive=True, event_filter=WATCH_EVENTS)
+    observer.start()
+    log("\nStarting to watch for new files using filesystem events...")
 
 def get_subtitle_info(video_path):
     command = [
         "ffprobe",
         "-v", "error",
         "-select_streams", "s",
-        "-show_entries", "stream=index:stream_tags=language",
-        "-of", "json",
+        "-show_entries", "stream=index,codec_name:stream_tags=language",
+        "-of", "csv=p=0",
         video_path
     ]
     result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         log(f"Error getting subtitle info for {video_path}: {result.stderr})")
         return None
-    return result.stdout
+
+    # One "index,codec_name,language" line per subtitle stream; the language is left out when the stream has no tag
+    subtitles = []
+    for line in result.stdout.splitlines():
+        if not line.strip():
+            continue
+        index, _, rest = line.partition(',')
+        codec_name, _, language = rest.partition(',')
+        subtitles.append((int(index), codec_name.strip(), language.strip() or 'und'))
+    return subtitles
 
 def extract_subtitle(video_path, subtitle_relative_index):
-    # Include the index in the output path to avoid overwriting
-    output_path = f"{os.path.splitext(video_path)[0]}.raw.{subtitle_relative_index}.srt"
+    # Stream the SRT on stdout instead of writing a temporary file
     command = [
         "ffmpeg",
         "-i", video_path,
         "-map", f"0:s:{subtitle_relative_index}",
         "-c:s", "srt",
-        output_path,
-        "-y" # Overwrite output file if it exists
+        "-f", "srt",
+        "pipe:1"
     ]
-    result = subprocess.run(command, capture_output=True, text=True)
+    result = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', errors='replace')
     if result.returncode != 0:
         log(f"Could not extract subtitle for {video_path} (stream {subtitle_relative_index}). It might be an image-based format. FFMPEG stderr: {result.stderr})")
         return None
-    return output_path
+    return result.stdout
 
-def translate_and_save_subtitle(subtitle_paths, video_path):
-    combined_subtitle_text = ""
-    for i, subtitle_path in enumerate(subtitle_paths):
-        try:
-            with open(subtitle_path, 'r', encoding='utf-8') as f:
-                subtitle_text = f.read()
-            if subtitle_text.strip():
-                combined_subtitle_text += f"--- Subtitle Version {i+1} ---\n{subtitle_text}\n\n"
-        except FileNotFoundError:
-            log(f"Could not find subtitle file {subtitle_path}. Skipping this version.")
-
-    if not combined_subtitle_text.strip():
-        log("All subtitle files were empty or unreadable. Skipping translation.")
-        return
+def extract_subtitles_batch(video_path, subtitle_relative_indices):
+    # Extract several subtitle streams with a single ffmpeg run so the container is only demuxed once.
+    # Every stream is written to its own pipe (ffmpeg's pipe:<fd> output) instead of a temporary file.
+    pipes = [os.pipe() for _ in subtitle_relative_indices]
+    command = ["ffmpeg", "-i", video_path]
+    for i, (_, write_fd) in zip(subtitle_relative_indices, pipes):
+        command += ["-map", f"0:s:{i}", "-c:s", "srt", "-f", "srt", f"pipe:{write_fd}"]
 
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        # Parse the combined subtitle text into SRT objects
-        # Assuming combined_subtitle_text contains multiple SRTs, we'll just take the first one for parsing
-        # For more robust handling, you might need to parse each subtitle_path separately
-        # For now, let's assume the first subtitle_path is the primary one to parse
-        with open(subtitle_paths[0], 'r', encoding='utf-8') as f:
-            subs = list(srt.parse(f.read()))
-        
-        total_subtitles = len(subs)
-        translated_subtitles = []
-        chunk_size = 10 # Translate 10 subtitles at a time
-
-        for i in range(0, total_subtitles, chunk_size):
-            chunk = subs[i:i + chunk_size]
-            chunk_text = srt.compose(chunk)
-
-            prompt = (
-                f"You are an expert translator specializing in subtitles for movies, TV, and animation. "
-                f"""Your task is to translate the provided SRT subtitle content into {TARGET_LANGUAGE}, making it sound as natural as possible, as if it were originally written in Korean.
+    subtitle_texts = [None] * len(pipes)
 
-"""
-                """Follow these instructions carefully:
-"""
-                """1. **Natural Translation:** The translation must be fluent and natural. Avoid stiff, literal translations.
-2. **Completeness:** It is absolutely critical that you translate the entire content from beginning to end. Do not omit any lines.
-3. **Strict SRT Format Preservation:** You MUST strictly preserve the original SRT format. This includes:
-   - Exact sequential numbering (e.g., 1, 2, 3...)
-   - Exact timestamps (e.g., 00:00:01,000 --> 00:00:03,500)
-   - All original formatting tags (e.g., <i>, <b>, <font color=\"#RRGGBB\">)
-   - Correct line breaks between subtitle text and the next number/timestamp block.
-   - Do NOT add any extra blank lines unless they are present in the original SRT.
-4. **Output ONLY SRT:** Your final output MUST be ONLY the complete, translated SRT file content. Do NOT include any conversational text, explanations, markdown code blocks (like ```srt or ```), or any other extraneous characters before or after the SRT content. Just the raw SRT text.
+    def read_subtitle(k, read_fd):
+        with open(read_fd, 'r', encoding='utf-8', errors='replace') as f:
+            subtitle_texts[k] = f.read()
 
-"""
-                f"{chunk_text}"
-            )
-            
-            retries = 5
-            for attempt in range(retries):
-                try:
-                    response = model.generate_content(prompt)
-                    translated_chunk_text = response.text
-                    break # If successful, break out of the retry loop
-                except ResourceExhausted as e:
-                    wait_time = min(60, 2**(attempt+1) * 5) # Cap at 60 seconds
-                    log(f"Quota exceeded for {video_path} (chunk {i}-{i+len(chunk)}). Retrying in {wait_time} seconds... ({e})")
-                    time.sleep(wait_time) # Exponential backoff with increased base
-                except Exception as e:
-                    log(f"Error generating content for {video_path} (chunk {i}-{i+len(chunk)}): {e})")
-                    translated_chunk_text = "" # Mark as empty to skip this chunk
-                    break # Exit if it's not a quota error
-            else: # This else block is executed if the loop completes without a 'break'
-                log(f"Failed to translate chunk {i}-{i+len(chunk)} for {video_path} after {retries} retries due to quota issues. Skipping this chunk.")
-                translated_chunk_text = "" # Mark as empty to skip this chunk
-
-            # Clean up potential markdown formatting from the response
-            if translated_chunk_text.strip().startswith("```srt"):
-                translated_chunk_text = translated_chunk_text.strip()[6:-3].strip()
-            elif translated_chunk_text.strip().startswith("```"):
-                 translated_chunk_text = translated_chunk_text.strip()[3:-3].strip()
-            
+    try:
+        process = subprocess.Popen(
+            command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            text=True, pass_fds=[write_fd for _, write_fd in pipes]
+        )
+    except OSError:
+        for read_fd, _ in pipes:
+            os.close(read_fd)
+        raise
+    finally:
+        # Only ffmpeg keeps the write ends open, so the readers see EOF once it exits
+        for _, write_fd in pipes:
+            os.close(write_fd)
+
+    # Drain every pipe concurrently so ffmpeg never blocks on a full pipe buffer
+    readers = [threading.Thread(target=read_subtitle, args=(k, read_fd)) for k, (read_fd, _) in enumerate(pipes)]
+    for reader in readers:
+        reader.start()
+    _, stderr = process.communicate()
+    for reader in readers:
+        reader.join()
+
+    if process.returncode != 0 and len(pipes) > 1:
+        # One unconvertible (e.g. image-based) stream fails the whole run, so retry the streams one by one
+        log(f"Could not extract subtitle streams {list(subtitle_relative_indices)} for {video_path} in one pass. Extracting them individually. FFMPEG stderr: {stderr})")
+        return [extract_subtitle(video_path, i) for i in subtitle_relative_indices]
+    if process.returncode != 0:
+        log(f"Could not extract subtitle for {video_path} (stream {subtitle_relative_indices[0]}). It might be an image-based format. FFMPEG stderr: {stderr})")
+        return [None]
+    return subtitle_texts
+
+def generate_content(model, prompt, temperature=None):
+    # Blocking Gemini call, run in a worker thread; the semaphore is shared by every video being translated
+    generation_config = {"temperature": temperature} if temperature is not None else None
+    with gemini_semaphore:
+        return model.generate_content(prompt, generation_config=generation_config)
+
+def get_retry_after(error):
+    # Seconds the API asked us to wait, from a Retry-After header (REST) or a RetryInfo detail (gRPC)
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    for detail in error.details or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    return None
+
+def add_jitter(wait_time):
+    # Spread retries out so concurrent requests that failed together don't retry in lockstep
+    return wait_time * (0.5 + random.random())
+
+def parse_translated_request(translated_chunk_text, video_path, i, chunk, expected_lengths, skip_invalid=False):
+    # expected_lengths maps every chunk number sent in the request to the number of subtitles in it
+    # Clean up potential markdown formatting from the response
+    fence_match = MARKDOWN_FENCE_RE.match(translated_chunk_text)
+    if fence_match:
+        translated_chunk_text = fence_match.group(1)
+
+    parts = CHUNK_MARKER_RE.split(translated_chunk_text)
+    if len(parts) == 1:
+        parts = ["", "1", translated_chunk_text] # The model dropped the markers
+    translated_parts = {int(chunk_number): translated_part for chunk_number, translated_part in zip(parts[1::2], parts[2::2])}
+
+    # Check every chunk on its own so that, once retries are used up, one malformed or incomplete chunk doesn't discard the others
+    translated_subtitles = []
+    for chunk_number, expected_length in expected_lengths.items():
+        try:
+            if chunk_number not in translated_parts:
+                raise ValueError(f"Chunk {chunk_number} is missing from the response")
+            part_subtitles = list(srt.parse(translated_parts[chunk_number].strip()))
+        except (ValueError, srt.SRTParseError) as e:
+            if not skip_invalid:
+                raise
+            log(f"Error parsing translated chunk for {video_path} (chunk {i}-{i+len(chunk)}, part {chunk_number}): {e}. Skipping this part.")
+            continue
+
+        if len(part_subtitles) != expected_length:
+            message = f"Chunk {chunk_number} has {len(part_subtitles)} subtitles instead of {expected_length}"
+            if not skip_invalid:
+                raise ValueError(message)
+            log(f"Incomplete translated chunk for {video_path} (chunk {i}-{i+len(chunk)}, part {chunk_number}): {message}. Keeping it anyway.")
+        translated_subtitles.extend(part_subtitles)
+
+    return translated_subtitles
+
+async def translate_request(model, semaphore, video_path, i, chunk):
+    # Translate one request's worth of subtitles and return the parsed translated subtitles,
+    # along with whether every chunk of the request came back complete
+    # sort_and_reindex drops the same subtitles srt.compose would, so the lengths match what is sent
+    source_parts = [list(srt.sort_and_reindex(chunk[j:j + CHUNK_SIZE])) for j in range(0, len(chunk), CHUNK_SIZE)]
+    source_parts = [part for part in source_parts if part]
+    expected_lengths = {k: len(part) for k, part in enumerate(source_parts, start=1)}
+    chunk_text = "\n".join(
+        f"### CHUNK {k} ###\n{srt.compose(part)}" for k, part in enumerate(source_parts, start=1)
+    )
+
+    prompt = PROMPT_PREFIX + chunk_text
+
+    quota_attempts = 0
+    validation_attempts = 0
+    network_attempts = 0
+    temperature = None
+    async with semaphore:
+        while True:
+            translated_chunk_text = ""
             try:
-                translated_subtitles.extend(list(srt.parse(translated_chunk_text)))
+                response = await asyncio.to_thread(generate_content, model, prompt, temperature)
+                # response.text raises ValueError as well when the response was blocked or empty
+                translated_chunk_text = response.text
+                if response.candidates[0].finish_reason == glm.Candidate.FinishReason.MAX_TOKENS:
+                    raise ValueError("The response was cut off at the output token limit")
+                return parse_translated_request(translated_chunk_text, video_path, i, chunk, expected_lengths), True
+            except ResourceExhausted as e:
+                if quota_attempts == QUOTA_RETRIES:
+                    log(f"Failed to translate chunk {i}-{i+len(chunk)} for {video_path} after {QUOTA_RETRIES} retries due to quota issues. Skipping this chunk.")
+                    return [], False
+                retry_after = get_retry_after(e)
+                if retry_after:
+                    # Never retry before the API allows it, only spread the retries out after that
+                    wait_time = retry_after * (1 + random.random() / 2)
+                else:
+                    wait_time = add_jitter(min(QUOTA_RETRY_MAX_WAIT, QUOTA_RETRY_BASE_WAIT * 2**quota_attempts))
+                quota_attempts += 1
+                log(f"Quota exceeded for {video_path} (chunk {i}-{i+len(chunk)}). Retrying in {wait_time:.1f} seconds... ({e})")
+                await asyncio.sleep(wait_time)
+            except (ValueError, srt.SRTParseError) as e:
+                if validation_attempts == len(VALIDATION_RETRY_TEMPERATURES):
+                    log(f"Invalid translation for {video_path} (chunk {i}-{i+len(chunk)}) after {validation_attempts} retries: {e}. Keeping the parts that can be parsed.")
+                    return parse_translated_request(translated_chunk_text, video_path, i, chunk, expected_lengths, skip_invalid=True), False
+                temperature = VALIDATION_RETRY_TEMPERATURES[validation_attempts]
+                validation_attempts += 1
+                log(f"Invalid translation for {video_path} (chunk {i}-{i+len(chunk)}): {e}. Retrying with temperature {temperature}...")
+            except NETWORK_ERRORS as e:
+                if network_attempts == len(NETWORK_RETRY_WAITS):
+                    log(f"Failed to translate chunk {i}-{i+len(chunk)} for {video_path} after {network_attempts} retries: {e}. Skipping this chunk.")
+                    return [], False
+                wait_time = add_jitter(NETWORK_RETRY_WAITS[network_attempts])
+                network_attempts += 1
+                log(f"Error generating content for {video_path} (chunk {i}-{i+len(chunk)}): {e}. Retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
             except Exception as e:
-                log(f"Error parsing translated chunk for {video_path} (chunk {i}-{i+len(chunk)}): {e}. Skipping this chunk.")
+                log(f"Error generating content for {video_path} (chunk {i}-{i+len(chunk)}): {e})")
+                return [], False # Skip this chunk if the error isn't retryable
+
+def iter_subtitle_chunks(subtitle_text, chunk_size):
+    # Split the parsed SRT into request-sized chunks of chunk_size subtitles
+    subtitles = srt.parse(subtitle_text)
+    while chunk := list(itertools.islice(subtitles, chunk_size)):
+        yield chunk
+
+async def translate_subtitles(model, video_path, subtitle_text):
+    # Chunks are independent, so up to GEMINI_CONCURRENCY requests per video run at once
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+    async def translate_indexed_request(k, i, chunk):
+        return k, len(chunk), *await translate_request(model, semaphore, video_path, i, chunk)
+
+    # The whole SRT is parsed before the first request is created, so a malformed file costs no quota
+    chunks = []
+    offset = 0 # Position of the chunk in the source SRT, used in the log messages
+    for chunk in iter_subtitle_chunks(subtitle_text, CHUNK_SIZE * CHUNKS_PER_REQUEST):
+        if any(subtitle.content.strip() for subtitle in chunk):
+            chunks.append((offset, chunk)) # Chunks without text are skipped, srt.compose drops empty subtitles anyway
+        offset += len(chunk)
+
+    if not chunks:
+        return None, 0
+
+    requests = [translate_indexed_request(k, i, chunk) for k, (i, chunk) in enumerate(chunks)]
+    total_subtitles = sum(len(chunk) for _, chunk in chunks)
+
+    # Requests may complete out of order; each one fills its own slot so the order is kept
+    results = [None] * len(requests)
+    translated_count = 0
+    failed_requests = 0
+    name = os.path.basename(video_path)
+    for task in asyncio.as_completed(requests):
+        k, chunk_length, translated_subtitles, complete = await task
+        results[k] = translated_subtitles
+        translated_count += chunk_length
+        if not complete:
+            failed_requests += 1
+
+        progress = translated_count / total_subtitles * 100
+        log(f"Translation progress for {name}: {progress:.2f}% ({translated_count}/{total_subtitles} subtitles translated)")
+
+    return itertools.chain.from_iterable(result for result in results if result), failed_requests
+
+def get_translated_subtitle_path(video_path):
+    base, _ = os.path.splitext(video_path)
+    return f"{base}.{TARGET_LANGUAGE}.srt"
+
+def translate_and_save_subtitle(subtitle_texts, video_path):
+    if not any(subtitle_text.strip() for subtitle_text in subtitle_texts):
+        log("All extracted subtitles were empty. Skipping translation.")
+        return
 
-            progress = (i + len(chunk)) / total_subtitles * 100
-            log(f"Translation progress for {os.path.basename(video_path)}: {progress:.2f}% ({i + len(chunk)}/{total_subtitles} subtitles translated)")
+    try:
+        # The first subtitle stream is the primary one to translate
+        translated_subtitles, failed_requests = asyncio.run(translate_subtitles(MODEL, video_path, subtitle_texts[0]))
+        if translated_subtitles is None:
+            log(f"No subtitles with text found in the extracted subtitle for {video_path}. Skipping translation.")
+            return
+
+        translated_subtitles = list(translated_subtitles)
+        if not translated_subtitles:
+            # Nothing is saved or recorded, so the video is translated again the next time it is picked up
+            log(f"Every translation request failed for {video_path}. Not saving a subtitle.")
+            return
 
         final_translated_srt = srt.compose(translated_subtitles)
-        output_path = f"{os.path.splitext(video_path)[0]}.{TARGET_LANGUAGE}.srt"
+        output_path = get_translated_subtitle_path(video_path)
 
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(final_translated_srt)
+        if failed_requests:
+            log(f"Partially translated subtitle saved to {output_path} ({failed_requests} request(s) failed)")
+            return 'partial'
         log(f"Translated subtitle saved to {output_path}")
+        return 'done'
 
     except Exception as e:
         log(f"Error translating or saving subtitle for {video_path}: {e}")
 
+def load_state():
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        log(f"Could not read state file {STATE_FILE}: {e}. Starting with an empty state.")
+        return {}
+
+def is_already_processed(video_file):
+    entry = processed_state.get(video_file)
+    if not entry:
+        return os.path.exists(get_translated_subtitle_path(video_file))
+    # A video replaced under the same name has to be translated again, even though its old subtitle is still there,
+    # and a partially translated video is retried
+    stat = os.stat(video_file)
+    if entry.get('mtime') != stat.st_mtime or entry.get('size') != stat.st_size:
+        return False
+    return entry.get('status') == 'done'
+
+def mark_processed(video_file, status):
+    try:
+        stat = os.stat(video_file)
+    except FileNotFoundError:
+        log(f"{os.path.basename(video_file)} was removed before its translation could be recorded.")
+        return
+    with state_lock:
+        processed_state[video_file] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'status': status}
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            # Write to a temporary file and swap it in so a crash never leaves a truncated state file
+            temp_path = f"{STATE_FILE}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(processed_state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, STATE_FILE)
+        except OSError as e:
+            log(f"Could not write state file {STATE_FILE}: {e}")
+
+def probe_video(video_file):
+    name = os.path.basename(video_file)
+    log(f"--- Processing: {name} ---")
+    try:
+        if is_already_processed(video_file):
+            log(f"{name} has already been translated to '{TARGET_LANGUAGE}'. Skipping.")
+            return
+    except FileNotFoundError:
+        log(f"{name} was removed before it could be processed. Skipping.")
+        return
+
+    try:
+        subtitles = get_subtitle_info(video_file)
+        if subtitles is None:
+            log(f"Could not retrieve subtitle information for {video_file}. Skipping.")
+            return
+
+        if not subtitles:
+            log("No subtitle streams found. Skipping.")
+            return
+
+        # Check if target language subtitle already exists
+        target_language = TARGET_LANGUAGE.lower()
+        if any(language.lower() == target_language for _, _, language in subtitles):
+            log(f"Target language '{TARGET_LANGUAGE}' subtitle already exists. Skipping.")
+            return
+
+        return subtitles
+    except ValueError:
+        log(f"Error parsing subtitle information for {video_file}. It might not be valid ffprobe output. Skipping.")
+
+def extract_video_subtitles(video_file, subtitles):
+    extracted_subtitles = []
+    first_extracted_subtitle = None
+
+    candidate_indices = range(min(len(subtitles), 3))
+    _, first_codec_name, _ = subtitles[0]
+    if first_codec_name in IMAGE_SUBTITLE_CODECS:
+        log(f"The first subtitle stream of {video_file} is image-based ({first_codec_name}). Skipping.")
+        return # Skip to next video file
+
+    # Extract every candidate stream up front in one ffmpeg run; the size of the first decides how many are kept.
+    # Image-based streams would fail the whole run, so they are left out and treated as not extractable.
+    text_indices = [i for i in candidate_indices if subtitles[i][1] not in IMAGE_SUBTITLE_CODECS]
+    candidate_subtitles = [None] * len(candidate_indices)
+    for i, subtitle_text in zip(text_indices, extract_subtitles_batch(video_file, text_indices)):
+        candidate_subtitles[i] = subtitle_text
+    first_extracted_subtitle = candidate_subtitles[0]
+    if first_extracted_subtitle is None:
+        log(f"Could not extract the first subtitle stream for {video_file}. Skipping.")
+        return # Skip to next video file
+
+    extracted_subtitles.append(first_extracted_subtitle) # Add to list for potential translation
+
+    # Check the size of the first extracted subtitle
+    first_subtitle_size_bytes = len(first_extracted_subtitle.encode('utf-8'))
+    first_subtitle_size_kb = first_subtitle_size_bytes / 1024 # Size in KB
+    log(f"First extracted subtitle size: {first_subtitle_size_kb:.2f} KB")
+
+    if first_subtitle_size_kb > 500:
+        log(f"Subtitle file size ({first_subtitle_size_kb:.2f} KB) exceeds 500KB. Skipping translation for {video_file}.")
+        return # Skip to next video file
+
+    num_to_extract_total = 0
+    if first_subtitle_size_kb <= 100:
+        num_to_extract_total = min(len(subtitles), 3)
+        log(f"Subtitle size <= 100KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
+    elif first_subtitle_size_kb <= 200:
+        num_to_extract_total = min(len(subtitles), 2)
+        log(f"Subtitle size <= 200KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
+    else: # > 200KB and <= 500KB
+        num_to_extract_total = min(len(subtitles), 1)
+        log(f"Subtitle size > 200KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
+
+    # Keep the additional streams that are wanted and drop the ones extracted only as candidates
+    # Start from index 1 because index 0 is already in extracted_subtitles
+    for i, additional_extracted_subtitle in enumerate(candidate_subtitles[1:num_to_extract_total], start=1):
+        if additional_extracted_subtitle is not None:
+            log(f"  - Successfully extracted stream {i}")
+            extracted_subtitles.append(additional_extracted_subtitle)
+        else:
+            log(f"Could not extract additional subtitle stream {i} for {video_file}. Continuing with extracted streams.")
+
+    return extracted_subtitles
+
+def translate_video(video_file, extracted_subtitles):
+    status = translate_and_save_subtitle(extracted_subtitles, video_file)
+    if status:
+        mark_processed(video_file, status)
+
+def run_stage(stage, input_queue, output_queue=None):
+    while True:
+        video_file, *stage_input = input_queue.get()
+        try:
+            stage_output = stage(video_file, *stage_input)
+        except Exception as e:
+            log(f"An unexpected error occurred while processing {video_file}: {e}")
+            stage_output = None
+
+        if output_queue is not None and stage_output is not None:
+            output_queue.put((video_file, stage_output))
+        else:
+            # The video was skipped at this stage or reached the end of the pipeline
+            log(f"--- Finished processing: {os.path.basename(video_file)} ---\n")
+
 
 def main():
     log("--- Subtitle Translator ---")
@@ -168,6 +677,8 @@ def main():
     log(f"Target language: {TARGET_LANGUAGE}")
     log("---------------------------")
 
+    processed_state.update(load_state())
+
     # Initial scan to populate the set of existing files
     last_scanned_files = set(get_video_files(WATCH_DIRECTORY))
     if last_scanned_files:
@@ -177,123 +688,19 @@ def main():
     else:
         log("Initial scan complete. No existing video files found.")
 
-    log(f"\nStarting to watch for new files. Scanning every {SCAN_INTERVAL} seconds...")
+    start_watcher(last_scanned_files)
 
-    while True:
-        current_files = set(get_video_files(WATCH_DIRECTORY))
-        new_files = current_files - last_scanned_files
-        removed_files = last_scanned_files - current_files
-
-        if new_files:
-            log(f"\nDetected {len(new_files)} new video file(s). Processing...")
-            for video_file in new_files:
-                log(f"--- Processing: {os.path.basename(video_file)} ---")
-                try:
-                    subtitle_info_str = get_subtitle_info(video_file)
-                    if not subtitle_info_str:
-                        log(f"Could not retrieve subtitle information for {video_file}. Skipping.")
-                        continue
-
-                    subtitle_info = json.loads(subtitle_info_str)
-                    subtitles = subtitle_info.get('streams', [])
-
-                    if not subtitles:
-                        log("No subtitle streams found. Skipping.")
-                        continue
-
-                    if any(sub.get('tags', {}).get('language', 'und').lower() == TARGET_LANGUAGE.lower() for sub in subtitles):
-                        log(f"Target language '{TARGET_LANGUAGE}' subtitle already exists. Skipping.")
-                        continue
-
-                    extracted_subtitle_paths = []
-                    first_extracted_path = None
-
-                    if not subtitles:
-                        log("No subtitle streams found. Skipping.")
-                        continue
-
-                    # Check if target language subtitle already exists
-                    if any(sub.get('tags', {}).get('language', 'und').lower() == TARGET_LANGUAGE.lower() for sub in subtitles):
-                        log(f"Target language '{TARGET_LANGUAGE}' subtitle already exists. Skipping.")
-                        continue
-
-                    # Always extract the first subtitle stream to check its size
-                    first_extracted_path = extract_subtitle(video_file, 0)
-                    if not first_extracted_path:
-                        log(f"Could not extract the first subtitle stream for {video_file}. Skipping.")
-                        continue # Skip to next video file
-
-                    extracted_subtitle_paths.append(first_extracted_path) # Add to list for potential translation and cleanup
-
-                    # Check the size of the first extracted subtitle
-                    first_subtitle_size_bytes = os.path.getsize(first_extracted_path)
-                    first_subtitle_size_kb = first_subtitle_size_bytes / 1024 # Size in KB
-                    log(f"First extracted subtitle size: {first_subtitle_size_kb:.2f} KB")
-
-                    if first_subtitle_size_kb > 500:
-                        log(f"Subtitle file size ({first_subtitle_size_kb:.2f} KB) exceeds 500KB. Skipping translation for {video_file}.")
-                        # Clean up the temporary file immediately
-                        for subtitle_file in extracted_subtitle_paths: # This will only contain first_extracted_path
-                            try:
-                                os.remove(subtitle_file)
-                                log(f"  - Removed temporary file: {os.path.basename(subtitle_file)}")
-                            except OSError as e:
-                                log(f"Error removing temporary subtitle file {subtitle_file}: {e}")
-                        continue # Skip to next video file
-
-                    num_to_extract_total = 0
-                    if first_subtitle_size_kb <= 100:
-                        num_to_extract_total = min(len(subtitles), 3)
-                        log(f"Subtitle size <= 100KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
-                    elif first_subtitle_size_kb <= 200:
-                        num_to_extract_total = min(len(subtitles), 2)
-                        log(f"Subtitle size <= 200KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
-                    else: # > 200KB and <= 500KB
-                        num_to_extract_total = min(len(subtitles), 1)
-                        log(f"Subtitle size > 200KB. Will attempt to extract up to {num_to_extract_total} subtitle streams.")
-
-                    # Extract additional subtitles if num_to_extract_total is greater than 1
-                    # Start from index 1 because index 0 is already extracted and in extracted_subtitle_paths
-                    for i in range(1, num_to_extract_total):
-                        if i < len(subtitles): # Ensure index is within bounds
-                            additional_extracted_path = extract_subtitle(video_file, i)
-                            if additional_extracted_path:
-                                log(f"  - Successfully extracted stream {i} to: {os.path.basename(additional_extracted_path)}")
-                                extracted_subtitle_paths.append(additional_extracted_path)
-                            else:
-                                log(f"Could not extract additional subtitle stream {i} for {video_file}. Continuing with extracted streams.")
-                        else:
-                            log(f"No more subtitle streams available to extract (requested {num_to_extract_total}, but only {len(subtitles)} exist).")
-                            break # No more streams to extract
-
-                    if extracted_subtitle_paths: # This check is important, as it might be empty if first extraction failed
-                        translate_and_save_subtitle(extracted_subtitle_paths, video_file)
-                        # Clean up all raw extracted subtitle files
-                        for subtitle_file in extracted_subtitle_paths:
-                            try:
-                                os.remove(subtitle_file)
-                                log(f"  - Removed temporary file: {os.path.basename(subtitle_file)}")
-                            except OSError as e:
-                                log(f"Error removing temporary subtitle file {subtitle_file}: {e}")
-                    else:
-                        log("Failed to extract any valid subtitle streams for translation. Skipping.")
-
-                except json.JSONDecodeError:
-                    log(f"Error parsing subtitle information for {video_file}. It might not be valid JSON. Skipping.")
-                except Exception as e:
-                    log(f"An unexpected error occurred while processing {video_file}: {e}")
-                finally:
-                    log(f"--- Finished processing: {os.path.basename(video_file)} ---\n")
-
-        if removed_files:
-            log(f"\nDetected {len(removed_files)} removed video file(s).")
-            for video_file in removed_files:
-                log(f"  - Removed: {os.path.basename(video_file)}")
-
-        last_scanned_files = current_files
-
-        # No log statement here for quiet running, it will only log when new files are detected.
-        time.sleep(SCAN_INTERVAL)
+    # Probing and extracting the next video overlaps with translating the previous ones
+    stages = [
+        (probe_video, video_queue, extract_queue),
+        (extract_video_subtitles, extract_queue, translate_queue),
+    ]
+    stages += [(translate_video, translate_queue, None)] * MAX_WORKERS
+    workers = [threading.Thread(target=run_stage, args=stage, daemon=True) for stage in stages]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":